@@ -25,7 +25,7 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys, codecs, getopt, logging, os, fnmatch, subprocess, time, multiprocessing
+import sys, codecs, getopt, io, json, heapq, logging, os, re, select, fnmatch, sqlite3, subprocess, shutil, time, collections, concurrent.futures, multiprocessing, multiprocessing.pool, multiprocessing.connection
 
 
 
@@ -43,7 +43,26 @@ def init_logging():
 
 # Constants
 FLAC_EXECUTABLE = './flac'
+METAFLAC_EXECUTABLE = './metaflac'
+VENDOR_STRING = 'reference libFLAC 1.3.3 20190804'
+FLAC_THREADS_MIN_VERSION = (1, 5)
+FLAC_MAX_THREADS = 64
 REENCODE_TIMEOUT = None
+MAX_RETRIES = 3
+LOW_PRIORITY_NICENESS = 10
+RESUME_MANIFEST_NAME = '.flac_reencode.manifest'
+RESUME_FSYNC_INTERVAL = 32
+RESUME_CHECK_THREADS = 32
+METAFLAC_BATCH_SIZE = 128
+VENDOR_CHECK_MIN_THREADS = 32
+WALK_MAX_THREADS = 32
+VENDOR_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'flac_batch_reencode', 'vendor_cache.sqlite')
+
+# FLAC format constants
+FLAC_MARKER = b'fLaC'
+FLAC_METADATA_VORBIS_COMMENT = 4
+FLAC_HEAD_SIZE = 4096
+ID3V2_MARKER = b'ID3'
 
 # Debug constants
 SILENT_FLAC = True
@@ -55,13 +74,23 @@ SILENT_FLAC = True
 def usage(argv_0, exit_val):
     print("FLAC Batch Reencode\n")
     print("A Python script for batch re-encoding many *.flac files recursively. This is useful to make sure that your whole FLAC library is using the latest version of the FLAC encoder, with maximum compression.\n")
-    print("Usage: %s [-h] [-f <folder>] [-m <mask>] [-p <n_parallel>] [--no-verify] [--flac <flac-path>]" % argv_0)
+    print("Usage: %s [-h] [-f <folder>] [-m <mask>] [-p <n_parallel>] [-j <flac_threads>] [--spread-threads] [-v [--vendor-string <vendor>] [--no-vendor-cache]] [--no-verify] [--max-retries <n>] [--resume] [--pin-cpus] [--low-priority] [--flac <flac-path>] [--metaflac <metaflac-path>]" % argv_0)
     print("\t-h / --help     :    Show this help.")
     print("\t-f / --folder   :    Root folder path for recursive search (default: '.').")
     print("\t-m / --mask     :    File mask (default: '*.flac').")
     print("\t-p / --parallel :    Maximum simultaneous encoder processes (default: max([CPU count]-1,1) = %d)." % max(multiprocessing.cpu_count()-1,1))
+    print("\t-j / --flac-threads : Encoder threads per file, requires FLAC %s or newer (default: 1, at most %d). When set, the default for '-p' becomes max(([CPU count]-1)/<flac_threads>,1)." % ('.'.join(str(x) for x in FLAC_THREADS_MIN_VERSION), FLAC_MAX_THREADS))
+    print("\t--spread-threads : When there are fewer files than '-p', split the encoder threads of all '-p' slots between them, requires FLAC %s or newer." % '.'.join(str(x) for x in FLAC_THREADS_MIN_VERSION))
+    print("\t-v / --vendor   :    Only re-encode files whose FLAC vendor string differs from <vendor>.")
+    print("\t--vendor-string :    Vendor string to compare against when using '-v' (default: the one written by <flac-path>, or '%s' if it cannot be determined)." % VENDOR_STRING)
+    print("\t--no-vendor-cache : Do not cache vendor strings between runs in '%s'." % VENDOR_CACHE_PATH)
     print("\t--no-verify     :    Do not verify output for encoding errors before overwriting original files. Faster, but in rare cases could result in corrupt files.")
+    print("\t--max-retries   :    Times to retry a file that failed to encode, waiting 1, 2, 4, ... seconds in between, before skipping it (default: %d). Exits with a non-zero status if any file was skipped." % MAX_RETRIES)
+    print("\t--resume        :    Skip files re-encoded by previous runs using '--resume' (tracked in '<folder>/%s'), unless they changed since." % RESUME_MANIFEST_NAME)
+    print("\t--pin-cpus      :    Pin each encoder process to the least busy CPU core, or to one core per thread when using '-j' (Linux only).")
+    print("\t--low-priority  :    Run encoders at a lower priority (nice %d and SCHED_BATCH on Linux, below normal on Windows), to keep the machine responsive." % LOW_PRIORITY_NICENESS)
     print("\t--flac          :    Path to the 'flac' executable (default: 'flac').")
+    print("\t--metaflac      :    Path to the 'metaflac' executable, used when a vendor string cannot be read directly (default: 'metaflac').")
     sys.exit(exit_val)
 
 
@@ -70,17 +99,29 @@ def main(argv):
     init_logging()
 
     # Parse opts
-    global root_folder, file_mask, verify_output, flac_path, n_parallel
+    global root_folder, file_mask, verify_output, flac_path, n_parallel, check_vendor, vendor_string, metaflac_path, pin_cpus, low_priority, flac_threads, flac_spread_threads, max_retries, vendor_cache, resume_manifest, flac_cmd, metaflac_cmd
     root_folder = '.'
     file_mask = '*.flac'
     verify_output = True
     flac_path = FLAC_EXECUTABLE
-    n_parallel = max(multiprocessing.cpu_count()-1,1)
+    check_vendor = False
+    vendor_string = None
+    use_vendor_cache = True
+    vendor_cache = None
+    metaflac_path = METAFLAC_EXECUTABLE
+    resume = False
+    resume_manifest = None
+    pin_cpus = False
+    low_priority = False
+    flac_threads = 1
+    flac_spread_threads = False
+    max_retries = MAX_RETRIES
+    n_parallel = None
 
     logging.debug('Argument List: %s', str(argv))
 
     try:
-        opts, args = getopt.getopt(argv[1:],'hf:m:vp:',['help','folder=','mask=','no-verify','flac=','parallel='])
+        opts, args = getopt.getopt(argv[1:],'hf:m:vp:j:',['help','folder=','mask=','vendor','vendor-string=','no-vendor-cache','no-verify','max-retries=','resume','pin-cpus','low-priority','flac=','metaflac=','parallel=','flac-threads=','spread-threads'])
     except getopt.GetoptError:
         usage(argv[0], 2)
     for opt, arg in opts:
@@ -90,10 +131,24 @@ def main(argv):
             root_folder = arg
         elif opt in ("-m", "--mask"):
             file_mask = arg
+        elif opt in ("-v", "--vendor"):
+            check_vendor = True
+        elif opt == "--vendor-string":
+            vendor_string = arg
+        elif opt == "--no-vendor-cache":
+            use_vendor_cache = False
         elif opt == "--no-verify":
             verify_output = False
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--pin-cpus":
+            pin_cpus = True
+        elif opt == "--low-priority":
+            low_priority = True
         elif opt == "--flac":
             flac_path = arg
+        elif opt == "--metaflac":
+            metaflac_path = arg
         elif opt in ("-p", "--parallel"):
             try:
                 n_parallel = int(arg)
@@ -103,17 +158,265 @@ def main(argv):
             if n_parallel <= 0:
                 logging.critical("'%s <n_parallel>' must have a positive integer", opt)
                 sys.exit(-4)
+        elif opt in ("-j", "--flac-threads"):
+            try:
+                flac_threads = int(arg)
+            except:
+                logging.critical("'%s <flac_threads>' must have a positive integer", opt)
+                sys.exit(-4)
+            if flac_threads <= 0:
+                logging.critical("'%s <flac_threads>' must have a positive integer", opt)
+                sys.exit(-4)
+            if flac_threads > FLAC_MAX_THREADS:
+                logging.critical("'%s <flac_threads>' must be at most %d", opt, FLAC_MAX_THREADS)
+                sys.exit(-4)
+        elif opt == "--spread-threads":
+            flac_spread_threads = True
+        elif opt == "--max-retries":
+            try:
+                max_retries = int(arg)
+            except:
+                logging.critical("'%s <n>' must have a non-negative integer", opt)
+                sys.exit(-4)
+            if max_retries < 0:
+                logging.critical("'%s <n>' must have a non-negative integer", opt)
+                sys.exit(-4)
+
+    # Fail early rather than once every file has been listed
+    if shutil.which(flac_path) is None:
+        logging.critical("Could not find the 'flac' executable '%s'.", flac_path)
+        sys.exit(-5)
+
+    # By default, skip the files already written by the installed encoder
+    if check_vendor and vendor_string is None:
+        vendor_string = get_flac_vendor_string()
+        if vendor_string is None:
+            vendor_string = VENDOR_STRING
+            logging.warning("Could not determine the vendor string of '%s', using '%s'.", flac_path, vendor_string)
+        else:
+            logging.info("Using vendor string '%s' of '%s'.", vendor_string, flac_path)
+
+    # Multi-threaded encoding is only supported by recent encoders
+    if flac_threads > 1 or flac_spread_threads:
+        flac_version = get_flac_version()
+        if flac_version is None or flac_version < FLAC_THREADS_MIN_VERSION:
+            logging.warning("'%s' does not support multi-threaded encoding (requires FLAC %s or newer), using 1 thread per file.", flac_path, '.'.join(str(x) for x in FLAC_THREADS_MIN_VERSION))
+            flac_threads = 1
+            flac_spread_threads = False
+
+    # Keep n_parallel * flac_threads close to the number of CPUs
+    if n_parallel is None:
+        n_parallel = max((multiprocessing.cpu_count()-1) // flac_threads, 1)
+
+    # The command lines are the same for every file, so build them once
+    flac_cmd = get_flac_cmd()
+    metaflac_cmd = (metaflac_path, '--show-vendor-tag', '--with-filename')
+
+    if check_vendor and use_vendor_cache:
+        try:
+            vendor_cache = VendorCache(VENDOR_CACHE_PATH)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Could not open vendor string cache '%s', continuing without it: %s", VENDOR_CACHE_PATH, e)
 
     # Start main process
     files = get_file_list(root_folder, file_mask)
 
+    if vendor_cache is not None:
+        vendor_cache.close()
+        vendor_cache = None
+
+    if resume:
+        manifest_path = os.path.join(root_folder, RESUME_MANIFEST_NAME)
+        try:
+            resume_manifest = ResumeManifest(manifest_path)
+        except OSError as e:
+            logging.critical("Could not open resume manifest '%s': %s", manifest_path, e)
+            sys.exit(-7)
+
+        # Checking a file is a single stat, so run them on a thread pool to overlap the I/O on slow storage
+        old_len = len(files)
+        with multiprocessing.pool.ThreadPool(RESUME_CHECK_THREADS) as pool:
+            done = pool.map(resume_manifest.contains, [file[0] for file in files], chunksize=32)
+        files = [file for file, skip in zip(files, done) if not skip]
+        if len(files) < old_len:
+            logging.info("Skipping %d file(s) already re-encoded by a previous run.", old_len - len(files))
+
+    failed = []
     if len(files) > 0:
-        reencode_files(files)
+        failed = reencode_files(files)
+
+    if resume_manifest is not None:
+        resume_manifest.close()
+
+    # Let scripts know that some files were skipped
+    if len(failed) > 0:
+        logging.critical("Finished with %d file(s) not re-encoded.", len(failed))
+        sys.exit(-6)
 
     logging.info('Finished.')
 
 
 
+def get_flac_cmd():
+    """Builds the encoder command line shared by all files, i.e. 'flac --force --best [-V] [-s]'.
+    The number of encoder threads is chosen per job (see 'ReencodeJob.start').
+
+    Returns:
+        tuple[str, ...]: The command line, to which the path of the file to re-encode is appended.
+    """
+    # Resolve the executable once, as CPython only uses the cheaper posix_spawn for executables given with a folder
+    cmd = [shutil.which(flac_path) or flac_path, '--force', '--best']
+    if verify_output:
+        cmd.append('-V')
+    if SILENT_FLAC:
+        cmd.append('-s')
+
+    return tuple(cmd)
+
+
+
+def get_flac_version():
+    """Queries the version of the 'flac' executable using 'flac --version'.
+
+    Returns:
+        tuple[int, ...]: Version numbers (ex: (1, 5, 0)), or None if it could not be determined.
+    """
+    try:
+        cmd_out = subprocess.check_output([flac_path, '--version'], stderr=subprocess.STDOUT, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    match = re.search(r'\d+(?:\.\d+)+', cmd_out)
+    if match is None:
+        return None
+
+    return tuple(int(x) for x in match.group(0).split('.'))
+
+
+
+def get_flac_vendor_string():
+    """Determines the vendor string written by the 'flac' executable, by encoding a couple of samples of silence and parsing the output.
+
+    Returns:
+        str: The vendor string, or None if it could not be determined.
+    """
+    cmd = [flac_path, '--silent', '--stdout', '--force-raw-format', '--endian=little', '--sign=signed', '--channels=1', '--bps=16', '--sample-rate=44100', '-']
+
+    try:
+        proc = subprocess.run(cmd, input=bytes(4), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+
+    return parse_vendor_string(io.BytesIO(proc.stdout)) or None
+
+
+
+def compile_file_mask(file_mask):
+    """Compiles a file mask once into a function checking whether a file name matches it, with the same semantics as 'fnmatch.fnmatch'.
+
+    Args:
+        file_mask (str): File mask using linux patterns (ex: '*.flac').
+
+    Returns:
+        Callable[[str], bool]: Function returning whether a file name matches 'file_mask'.
+    """
+    mask = os.path.normcase(file_mask)
+    case_sensitive = (os.path.normcase('A') == 'A')
+
+    # Fast path for the common '*.flac'-style masks
+    if mask.startswith('*') and not any(c in mask[1:] for c in '*?['):
+        suffix = mask[1:]
+        if case_sensitive:
+            return lambda name: name.endswith(suffix)
+        return lambda name: os.path.normcase(name).endswith(suffix)
+
+    match = re.compile(fnmatch.translate(mask)).match
+    if case_sensitive:
+        return match
+    return lambda name: match(os.path.normcase(name))
+
+
+
+def scan_folder(folder, rel_folder, matches_mask):
+    """Lists the files matching a file mask and the subfolders of a single folder.
+
+    Args:
+        folder (str): Folder to list.
+        rel_folder (str): Path of 'folder' relative to the root folder of the search.
+        matches_mask (Callable[[str], bool]): File mask matcher (see 'compile_file_mask').
+
+    Returns:
+        tuple[list[tuple[str, str]], list[tuple[str, str]]]: Matching files and subfolders of 'folder', each as a path and the same path relative to the root folder.
+    """
+    logger = logging.getLogger('scan_folder')
+    logger.debug("Searching '%s'", folder)
+
+    # Relative paths of the entries only need a concatenation, rather than a call to os.path.join per entry
+    rel_prefix = os.path.join(rel_folder, '')
+
+    files = []
+    subfolders = []
+    try:
+        # os.scandir entries already know whether they are folders, so no extra 'stat' is needed per file
+        with os.scandir(folder) as it:
+            for entry in it:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir() # follows symlinks
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    subfolders.append((entry.path, rel_prefix + name))
+                elif matches_mask(name):
+                    logger.debug("File '%s' matches mask", entry.path)
+                    files.append((entry.path, rel_prefix + name))
+    except OSError as e:
+        logger.warning("Could not search '%s': %s", folder, e)
+
+    return (files, subfolders)
+
+
+
+def walk_files(root_folder, file_mask):
+    """Recursively searches a folder for a specific file mask, yielding matching files as they are found.
+    Folders are listed concurrently by a thread pool, since listing them is bound by file system latency.
+
+    Args:
+        root_folder (str): Root folder for recursive search.
+        file_mask (str): File mask using linux patterns (ex: '*.flac').
+
+    Yields:
+        tuple[str, str]: Path of each file inside 'folder' matching 'mask', and the same path relative to 'folder'
+    """
+
+    matches_mask = compile_file_mask(file_mask)
+    n_threads = min(WALK_MAX_THREADS, n_parallel * 4)
+
+    # Folders are yielded in the order they are found (breadth-first), while their subfolders are already being listed
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        pending = collections.deque([executor.submit(scan_folder, root_folder, '', matches_mask)])
+        while len(pending) > 0:
+            files, subfolders = pending.popleft().result()
+
+            for subfolder, rel_subfolder in subfolders:
+                pending.append(executor.submit(scan_folder, subfolder, rel_subfolder, matches_mask))
+
+            yield from files
+
+
+
+def get_file_size(file):
+    """Returns the size of a file in bytes, or 0 if it cannot be determined."""
+    try:
+        return os.stat(file).st_size
+    except OSError:
+        return 0
+
+
+
 def get_file_list(root_folder, file_mask):
     """Recursively searches a folder for a specific file mask, and creates a list of all such files.
 
@@ -122,24 +425,60 @@ def get_file_list(root_folder, file_mask):
         file_mask (str): File mask using linux patterns (ex: '*.flac').
 
     Returns:
-        List[str]: Paths of all files inside 'folder' matching 'mask'
+        List[tuple[str, str]]: Paths (absolute and relative to 'folder') of all files inside 'folder' matching 'mask' (and, if 'check_vendor' is set, whose vendor string differs from 'vendor_string'), largest files first
     """
 
     logger = logging.getLogger('get_file_list')
     logger.setLevel(logging.INFO)
 
-    out_files = []
-
     logger.info("Searching '%s' recursively for files matching mask '%s'...", root_folder, file_mask)
 
-    for root, dirs, files in os.walk(root_folder, followlinks=True):
-        logger.debug("Found file(s) in '%s': %s", root, str(files))
-        for name in files:
-            if fnmatch.fnmatch(name, file_mask):
-                path = os.path.join(root, name)
-                logger.debug("File '%s' matches mask", path)
-
-                out_files.append(path)
+    paths = walk_files(root_folder, file_mask)
+
+    if check_vendor:
+        # Vendor checks are small reads, so keep many of them in flight regardless of the CPU count
+        n_threads = max(n_parallel, VENDOR_CHECK_MIN_THREADS)
+        logger.info("Checking vendor strings using %d thread(s)...", n_threads)
+
+        def check(file):
+            return (file, compare_vendor_string(file[0]))
+
+        # Vendor checks are I/O bound, so threads are enough to run them concurrently.
+        # The pool consumes 'paths' lazily, so checks start while the folder is still being walked.
+        out_files = []
+        unknown_files = []
+        out_files_append = out_files.append
+        unknown_files_append = unknown_files.append
+        try:
+            with multiprocessing.pool.ThreadPool(n_threads) as pool:
+                for file, match in pool.imap(check, paths, chunksize=32):
+                    if match is None:
+                        unknown_files_append(file)
+                    elif not match:
+                        out_files_append(file)
+
+            # Files that could not be parsed in-process are checked using metaflac, several files per invocation
+            if len(unknown_files) > 0:
+                logger.info("Checking vendor string of %d file(s) using '%s'...", len(unknown_files), metaflac_path)
+
+                for i in range(0, len(unknown_files), METAFLAC_BATCH_SIZE):
+                    batch = unknown_files[i:i+METAFLAC_BATCH_SIZE]
+                    vendors = read_vendor_strings_metaflac([path for path, rel_path in batch])
+                    out_files.extend(file for file in batch if vendors.get(file[0]) != vendor_string)
+
+                    if vendor_cache is not None:
+                        for path, vendor in vendors.items():
+                            vendor_cache.set(path, vendor)
+
+        finally:
+            # Also keep whatever was checked if the search is interrupted
+            if vendor_cache is not None:
+                vendor_cache.save()
+    else:
+        out_files = list(paths)
+
+    # Largest files first, so that a long encode is not started last while the other encoders sit idle
+    out_files.sort(key=lambda file: get_file_size(file[0]), reverse=True)
 
     logger.info("Found %d file(s).", len(out_files))
     logger.debug("Found file(s): %s", str(out_files))
@@ -147,32 +486,429 @@ def get_file_list(root_folder, file_mask):
 
 
 
+def parse_vendor_string(f):
+    """Parses the vendor string of a FLAC stream from its VORBIS_COMMENT metadata block.
+
+    Args:
+        f (BinaryIO): Seekable binary file object positioned at the start of the stream.
+
+    Returns:
+        str: The vendor string ('' if the stream has no VORBIS_COMMENT block), or None if it is not a native FLAC stream.
+    """
+    # The metadata blocks usually fit in the first few KiB, so read them with a single system call
+    # and only seek past that when a block (e.g. a large picture or padding) does not
+    head = f.read(FLAC_HEAD_SIZE)
+
+    def read(pos, size):
+        if pos + size <= len(head):
+            return head[pos:pos+size]
+        f.seek(pos)
+        return f.read(size)
+
+    pos = 0
+    marker = read(pos, 4)
+
+    # Skip a leading ID3v2 tag, if any
+    if marker[:3] == ID3V2_MARKER:
+        header = read(pos, 10)
+        if len(header) != 10:
+            return None
+        size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        if header[5] & 0x10:
+            size += 10 # footer
+        pos += 10 + size
+        marker = read(pos, 4)
+
+    if marker != FLAC_MARKER:
+        return None
+    pos += 4
+
+    # Iterate metadata blocks until the VORBIS_COMMENT block is found
+    last = False
+    while not last:
+        header = read(pos, 4)
+        if len(header) != 4:
+            return None
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], 'big')
+        pos += 4
+
+        if block_type == FLAC_METADATA_VORBIS_COMMENT:
+            vendor_length = int.from_bytes(read(pos, 4), 'little')
+            if vendor_length > length - 4:
+                return None
+            vendor = read(pos + 4, vendor_length)
+            if len(vendor) != vendor_length:
+                return None
+            return vendor.decode('utf-8', 'replace')
+
+        pos += length
+
+    return ''
+
+
+def read_vendor_string(file):
+    """Reads the vendor string of a FLAC file directly from its VORBIS_COMMENT metadata block, without spawning 'metaflac'.
+
+    Args:
+        file (str): Path of the FLAC file.
+
+    Returns:
+        str: The vendor string ('' if the file has no VORBIS_COMMENT block), or None if the file could not be parsed as a native FLAC stream.
+    """
+    try:
+        with open(file, 'rb', buffering=0) as f:
+            return parse_vendor_string(f)
+    except OSError:
+        return None
+
+
+def read_vendor_strings_metaflac(files):
+    """Reads the vendor strings of several FLAC files using a single 'metaflac --show-vendor-tag --with-filename <files>' invocation.
+
+    Args:
+        files (list[str]): Paths of the FLAC files.
+
+    Returns:
+        Dict[str, str]: Vendor string of each file. Files for which 'metaflac' failed are omitted.
+    """
+    logger = logging.getLogger('read_vendor_strings_metaflac')
+
+    cmd = [*metaflac_cmd, *files]
+
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        logger.warning("Could not run '%s': %s", metaflac_path, e)
+        return {}
+
+    if proc.returncode != 0:
+        logger.warning("'%s' exited with error code %d:\n%s", metaflac_path, proc.returncode, os.fsdecode(proc.stderr.strip()))
+
+    # Output is one '<file>:<vendor>' line per successfully read file, in the same order as 'files'
+    vendors = {}
+    remaining = iter(files)
+    for line in proc.stdout.splitlines():
+        line = os.fsdecode(line)
+        for file in remaining:
+            prefix = file + ':'
+            if line.startswith(prefix):
+                vendors[file] = line[len(prefix):]
+                break
+
+    return vendors
+
+
+class VendorCache(object):
+    def __init__(self, path):
+        """Opens (or creates) a persistent cache of FLAC vendor strings.
+        Entries are keyed by absolute file path, and are only used while the file's size, modification time, inode and change time are unchanged.
+        The inode and change time catch re-encodes, as flac replaces the file but keeps its modification time.
+
+        Args:
+            path (str): Path of the SQLite database holding the cache.
+        """
+        self.log = logging.getLogger('VendorCache')
+        self.log.setLevel(logging.INFO)
+
+        self.path = path
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.db = sqlite3.connect(path)
+        with self.db:
+            # Older caches were keyed by size and modification time only, and cannot be trusted
+            self.db.execute("DROP TABLE IF EXISTS vendors")
+            self.db.execute("CREATE TABLE IF NOT EXISTS vendors_v2 (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, ino INTEGER NOT NULL, ctime_ns INTEGER NOT NULL, vendor TEXT NOT NULL) WITHOUT ROWID")
+
+        # The whole cache is loaded up-front, so that lookups from the vendor check threads do not touch the database
+        self.entries = {}
+        for path, size, mtime_ns, ino, ctime_ns, vendor in self.db.execute("SELECT path, size, mtime_ns, ino, ctime_ns, vendor FROM vendors_v2"):
+            self.entries[path] = ((size, mtime_ns, ino, ctime_ns), vendor)
+        self.updates = {}
+
+        self.log.debug("Loaded %d cached vendor string(s) from '%s'", len(self.entries), self.path)
+
+    def _key(self, file):
+        st = os.stat(file)
+        return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+    def get(self, file):
+        """Looks up the cached vendor string of a file.
+
+        Args:
+            file (str): Path of the FLAC file.
+
+        Returns:
+            str: The cached vendor string, or None if it is not cached or the file changed since it was cached.
+        """
+        try:
+            key = self._key(file)
+        except OSError:
+            return None
+
+        entry = self.entries.get(os.path.abspath(file))
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def set(self, file, vendor):
+        """Caches the vendor string of a file. The change is only persisted by 'save'.
+
+        Args:
+            file (str): Path of the FLAC file.
+            vendor (str): Its vendor string.
+        """
+        try:
+            key = self._key(file)
+        except OSError:
+            return
+
+        path = os.path.abspath(file)
+        self.entries[path] = (key, vendor)
+        self.updates[path] = (key, vendor)
+
+    def save(self):
+        """Writes the entries changed since the last call to the database, in a single transaction."""
+        if len(self.updates) == 0:
+            return
+
+        rows = [(path, *key, vendor) for path, (key, vendor) in self.updates.items()]
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO vendors_v2 (path, size, mtime_ns, ino, ctime_ns, vendor) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            self.log.warning("Could not save vendor string cache '%s': %s", self.path, e)
+            return
+
+        self.log.debug("Saved %d vendor string(s) to '%s'", len(rows), self.path)
+        self.updates = {}
+
+    def close(self):
+        """Saves pending entries and closes the database."""
+        self.save()
+        self.db.close()
+
+
+
+def compare_vendor_string(file):
+    """Checks whether the vendor string of a FLAC file matches 'vendor_string', using 'vendor_cache' if available or otherwise reading it in-process.
+
+    Args:
+        file (str): Path of the FLAC file.
+
+    Returns:
+        bool: Whether the vendor string of 'file' matches 'vendor_string', or None if it could not be read without 'metaflac'.
+    """
+    vendor = vendor_cache.get(file) if vendor_cache is not None else None
+
+    if vendor is None:
+        vendor = read_vendor_string(file)
+        if vendor is None:
+            return None
+
+        if vendor_cache is not None:
+            vendor_cache.set(file, vendor)
+
+    res = (vendor == vendor_string)
+    return res
+
+
+
+class ResumeManifest(object):
+    log = logging.getLogger('ResumeManifest')
+    log.setLevel(logging.INFO)
+
+    def __init__(self, path):
+        """Opens (or creates) a manifest of successfully re-encoded files, used to resume interrupted runs.
+        Each line holds a JSON list with the absolute path, size and modification time of a file right after it was re-encoded.
+
+        Args:
+            path (str): Path of the manifest file.
+        """
+        self.path = path
+
+        self.entries = {}
+        n_lines = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        file, size, mtime_ns = json.loads(line)
+                    except ValueError: # e.g. last line cut short by a crash
+                        continue
+                    self.entries[file] = (size, mtime_ns)
+
+        self.log.debug("Loaded %d re-encoded file(s) from '%s'", len(self.entries), self.path)
+
+        # Files re-encoded again get a new line each time, so drop the outdated (and unreadable) lines
+        if n_lines > len(self.entries):
+            self._compact()
+
+        self.f = open(path, 'a', encoding='utf-8')
+        self.unsynced = 0
+
+    def _compact(self):
+        """Rewrites the manifest with a single line per file. The new manifest replaces the old one atomically."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for file, (size, mtime_ns) in self.entries.items():
+                f.write(json.dumps([file, size, mtime_ns]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        self.log.debug("Compacted '%s'", self.path)
+
+    def _key(self, file):
+        st = os.stat(file)
+        return (st.st_size, st.st_mtime_ns)
+
+    def contains(self, file):
+        """Checks whether a file was re-encoded by a previous run, and has not changed since.
+
+        Args:
+            file (str): Path of the file.
+
+        Returns:
+            bool: Whether 'file' can be skipped.
+        """
+        entry = self.entries.get(os.path.abspath(file))
+        if entry is None:
+            return False
+
+        try:
+            return self._key(file) == entry
+        except OSError:
+            return False
+
+    def add(self, file):
+        """Records that a file was successfully re-encoded.
+        Each entry is flushed immediately, and synced to disk every 'RESUME_FSYNC_INTERVAL' entries.
+
+        Args:
+            file (str): Path of the file.
+        """
+        try:
+            size, mtime_ns = self._key(file)
+        except OSError as e:
+            self.log.warning("Could not record '%s' in resume manifest: %s", file, e)
+            return
+
+        path = os.path.abspath(file)
+        self.entries[path] = (size, mtime_ns)
+        self.f.write(json.dumps([path, size, mtime_ns]) + '\n')
+        self.f.flush()
+
+        self.unsynced += 1
+        if self.unsynced >= RESUME_FSYNC_INTERVAL:
+            os.fsync(self.f.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        """Syncs and closes the manifest."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+
+def _process_threads(pid):
+    """Lists the threads of a process other than its main thread.
+    On Linux, scheduling calls given a process ID only apply to its main thread, so they must also be applied to the threads it already created.
+    Threads created later inherit the settings of the main thread, so it should be updated first.
+
+    Args:
+        pid (int): Process ID.
+
+    Returns:
+        list[int]: Thread IDs, empty if not available (e.g. not on Linux).
+    """
+    try:
+        return [tid for tid in map(int, os.listdir('/proc/%d/task' % pid)) if tid != pid]
+    except OSError:
+        return []
+
+
+
+def _decode(output):
+    return output.decode('utf-8', 'replace')
+
+
+
 class ReencodeJob(object):
-    def __init__(self, file):
+    # One job is created per file, so the logger is only looked up and configured once, here
+    log = logging.getLogger('ReencodeJob')
+    log.setLevel(logging.INFO)
+
+    def __init__(self, file, threads=1):
         """Constructs a ReencodeJob for a file
 
         Args:
             file (str): Path of file to re-encode.
+            threads (int): Number of encoder threads, requires FLAC 1.5 or newer if above 1.
         """
-        self.log = logging.getLogger('ReencodeJob')
-        self.log.setLevel(logging.INFO)
-    
         self.file = file
-
+        self.threads = threads
+        self.retries = 0
+        self.tmp_file = file + ".tmp,fl-ac+en'c"
+        self.cpus = None
+        self.pidfd = None
         
     def start(self):
-        """Starts the re-encoding process for a file using 'flac <file> -V -s --force --best'
+        """Starts the re-encoding process for a file using 'flac --force --best -V -s [--threads=<n>] <file>'
         """
 
-        cmd = [flac_path, self.file, '--force', '--best']
-        if verify_output:
-            cmd.append('-V')
-        if SILENT_FLAC:
-            cmd.append('-s')
+        if self.threads > 1:
+            cmd = [*flac_cmd, '--threads=%d' % self.threads, self.file]
+        else:
+            cmd = [*flac_cmd, self.file]
+
+        # A silent encoder writes nothing useful to stdout, so only capture it when it will be logged.
+        # stderr is always captured, as it holds the error messages.
+        if SILENT_FLAC and not self.log.isEnabledFor(logging.DEBUG):
+            stdout = subprocess.DEVNULL
+        else:
+            stdout = subprocess.PIPE
+
+        creationflags = 0
+        if low_priority and os.name == 'nt':
+            creationflags = subprocess.BELOW_NORMAL_PRIORITY_CLASS
 
         self.start_time = time.time()
         
-        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        # Not closing file descriptors lets CPython spawn with posix_spawn instead of fork+exec, whose cost grows with our memory usage.
+        # This is safe since Python creates file descriptors as non-inheritable.
+        self.proc = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE, close_fds=(os.name == 'nt'), creationflags=creationflags)
+
+        if low_priority and os.name != 'nt':
+            self._lower_priority()
+
+    def _lower_priority(self):
+        """Marks the encoder as a background batch job: lower niceness, and SCHED_BATCH where supported.
+        This is done from the parent rather than through 'preexec_fn', which would prevent spawning with posix_spawn.
+        The main thread is updated first, then the threads the encoder already created (see '_process_threads').
+        """
+        try:
+            self._lower_thread_priority(self.proc.pid)
+        except OSError as e: # e.g. the process already exited
+            self.log.debug("Could not lower the priority of '%s': %s", self.file, e)
+            return
+
+        for tid in _process_threads(self.proc.pid):
+            try:
+                self._lower_thread_priority(tid)
+            except OSError: # e.g. the thread already exited
+                pass
+
+    def _lower_thread_priority(self, tid):
+        os.setpriority(os.PRIO_PROCESS, tid, LOW_PRIORITY_NICENESS)
+        if hasattr(os, 'SCHED_BATCH'):
+            os.sched_setscheduler(tid, os.SCHED_BATCH, os.sched_param(0))
 
     def finish(self):
         """Finishes the re-encoding process for a file. To be exact, checks whether an error occurred.
@@ -180,28 +916,57 @@ class ReencodeJob(object):
         Returns:
             bool: Whether 'proc' terminated successfuly.
         """
-        (cmd_out, cmd_err) = self.proc.communicate()
+        if self.proc.stdout is None:
+            # Only stderr is captured, so read it directly rather than through 'communicate', which sets up a selector (or threads on Windows)
+            cmd_out = b''
+            cmd_err = self.proc.stderr.read()
+            self.proc.stderr.close()
+            self.proc.wait()
+        else:
+            (cmd_out, cmd_err) = self.proc.communicate()
+        # Output is kept as bytes, and only decoded when it is actually logged
         cmd_out = cmd_out.strip()
         cmd_err = cmd_err.strip()
 
         if self.proc.returncode != 0:
-            self.log.critical("File '%s' exited with error code: %d\nSTDOUT:\n%s\nSTDERR: %s", self.file, self.proc.returncode, cmd_out, cmd_err)
+            self.log.critical("File '%s' exited with error code: %d\nSTDOUT:\n%s\nSTDERR: %s", self.file, self.proc.returncode, _decode(cmd_out), _decode(cmd_err))
             return False
 
-        self.log.debug("File '%s' STDOUT:\n%s\nSTDERR: %s", self.file, cmd_out, cmd_err)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("File '%s' STDOUT:\n%s\nSTDERR: %s", self.file, _decode(cmd_out), _decode(cmd_err))
 
         if SILENT_FLAC and (cmd_out or cmd_err):
-            if "Compression failed (ratio" not in cmd_err:
-                self.log.warning("File '%s' - output was not empty:\nSTDOUT: %s\nSTDERR: %s", self.file, cmd_out, cmd_err)
+            if b"Compression failed (ratio" not in cmd_err:
+                self.log.warning("File '%s' - output was not empty:\nSTDOUT: %s\nSTDERR: %s", self.file, _decode(cmd_out), _decode(cmd_err))
             else:
                 self.log.warning("File '%s': Could not compress further", self.file)
 
+        self._drop_cache()
+
         return True
+
+    def _drop_cache(self):
+        """Hints the kernel that the re-encoded file will not be read again, so that its pages do not crowd other files out of the page cache."""
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        try:
+            fd = os.open(self.file, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            self.log.debug("File '%s': posix_fadvise failed: %s", self.file, e)
+        finally:
+            os.close(fd)
         
     def _remove_tmp(self):
-        tmp_filename = self.file + ".tmp,fl-ac+en'c"
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
+        try:
+            os.remove(self.tmp_file)
+        except FileNotFoundError:
+            pass
         
     def wait(self):
         """Wait for the re-encode job to finish"""
@@ -233,27 +998,114 @@ class ReencodeJob(object):
 
 
 class ReencodeJobList(object):
-    def __init__(self):
-        self.log = logging.getLogger('ReencodeJobList')
-        self.log.setLevel(logging.INFO)
+    log = logging.getLogger('ReencodeJobList')
+    log.setLevel(logging.INFO)
 
-        self.jobs = []
-
-    def start(self, file):
-        job = ReencodeJob(file)
-        self.jobs.append(job)
-        
-        job.start()
+    def __init__(self):
+        # Running jobs, keyed by process ID
+        self.jobs = {}
+
+        # Number of running jobs pinned to each CPU, if pinning is enabled and supported
+        self.cpu_jobs = {}
+        if pin_cpus:
+            if hasattr(os, 'sched_setaffinity'):
+                self.cpu_jobs = {cpu: 0 for cpu in sorted(os.sched_getaffinity(0))}
+            else:
+                self.log.warning("CPU pinning is not supported on this platform, ignoring.")
+
+        # Failed jobs waiting to be retried, as a heap of (ready time, sequence number, job)
+        self.retry_queue = []
+        self.retry_seq = 0
+
+        # Files that still failed after all retries
+        self.failed = []
+
+        # On Linux, watch a process file descriptor per job, so that the kernel reports exactly which jobs finished
+        self.epoll = None
+        self.pidfd_jobs = {}
+        if hasattr(os, 'pidfd_open') and hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+
+    def start(self, file, threads=1):
+        job = ReencodeJob(file, threads)
+        self._start(job)
+
+    def _start(self, job):
+        try:
+            job.start()
+        except OSError as e: # e.g. the file or the encoder is on storage that went away
+            self.log.critical("File '%s': could not start encoder: %s", job.file, e)
+            self._retry(job)
+            return
+
+        self.jobs[job.proc.pid] = job
+        self._watch(job)
+
+        # Pin the encoder to the least busy CPUs (its own, unless there are more threads than CPUs), one per encoder thread,
+        # so that it does not migrate between cores
+        if len(self.cpu_jobs) > 0:
+            n_cpus = min(job.threads, len(self.cpu_jobs))
+            job.cpus = set(sorted(self.cpu_jobs, key=self.cpu_jobs.get)[:n_cpus])
+            for cpu in job.cpus:
+                self.cpu_jobs[cpu] += 1
+            try:
+                os.sched_setaffinity(job.proc.pid, job.cpus)
+            except OSError as e: # e.g. the process already exited
+                self.log.debug("Could not pin '%s' to CPU(s) %s: %s", job.file, sorted(job.cpus), e)
+            else:
+                for tid in _process_threads(job.proc.pid):
+                    try:
+                        os.sched_setaffinity(tid, job.cpus)
+                    except OSError: # e.g. the thread already exited
+                        pass
+
+    def _watch(self, job):
+        if self.epoll is None:
+            return
+
+        try:
+            job.pidfd = os.pidfd_open(job.proc.pid)
+        except OSError as e: # e.g. kernel older than 5.3
+            self.log.debug("pidfd_open is not supported, falling back to os.waitid: %s", e)
+            self.epoll.close()
+            self.epoll = None
+            for other in self.pidfd_jobs.values():
+                self._unwatch(other)
+            self.pidfd_jobs = {}
+            return
+
+        self.pidfd_jobs[job.pidfd] = job
+        self.epoll.register(job.pidfd, select.EPOLLIN)
+
+    def _unwatch(self, job):
+        if job.pidfd is None:
+            return
+
+        if self.epoll is not None:
+            self.epoll.unregister(job.pidfd)
+            del self.pidfd_jobs[job.pidfd]
+        os.close(job.pidfd)
+        job.pidfd = None
+
+    def _release_cpu(self, job):
+        if job.cpus is not None:
+            for cpu in job.cpus:
+                self.cpu_jobs[cpu] -= 1
+            job.cpus = None
         
     def finish(self, job, wait=False):
-        """Check if a finished process was successful, or exit the application with an error code.
+        """Check if a finished process was successful, otherwise schedule it to be retried (or skip it once out of retries).
+        Ownership check and removal are O(1) lookups in 'jobs', which is keyed by process ID.
 
         Args:
-            procs (list[tuple[string, Popen]]): File names and corresponding Popen objects
-            proc_typle (tuple[string, Popen]): File name and Popen object to check (must be a member of 'procs')
+            job (ReencodeJob): Job to check (must be owned by this list)
+            wait (bool): Whether to wait for the job to finish, rather than returning if it is still running
+
+        Returns:
+            bool: Whether the job had finished.
         """
         # Sanity check
-        if job not in self.jobs:
+        if self.jobs.get(job.proc.pid) is not job:
             raise ValueError("'job' is not owned by the current 'ReencodeJobsList' instance")
         
         if not wait:
@@ -262,65 +1114,147 @@ class ReencodeJobList(object):
                 return False
 
         # Remove from list since it has finished
-        old_len = len(self.jobs)
-        self.jobs.remove(job)
-        if len(self.jobs) >= old_len:
-            raise RuntimeError("Could not remove job")
+        del self.jobs[job.proc.pid]
+        self._unwatch(job)
+        self._release_cpu(job)
 
-        # Check if job fails and we need to restart it (or exit)
+        # Check if job failed and we need to retry it (or skip it)
         success = job.finish()
+        if success and resume_manifest is not None:
+            resume_manifest.add(job.file)
         if not success:
-            # Ask user what they want to do
-            has_input = False
-            user_input = ""
-            while not has_input:
-                user_input = input("Encoding failed. Do you wish to [r]etry, [s]kip or [a]bort? ").lower()
-                if len(user_input) != 1 or user_input not in ('r', 's', 'a'):
-                    print("Invalid answer '%s'." % (user_input))
-                else:
-                    has_input = True
-
-            # abort
-            if user_input == 'a':
-                self.wait()
-                self.log.critical("Exiting.")
-                sys.exit(-6)
-
-            # retry
-            elif user_input == 'r':
-                self.jobs.append(job)
-                job.start()
+            self._retry(job)
 
         # Done
         return True
-    
-    def wait(self):
-        """Wait for processes in 'jobs' to terminate, and if necessary removes the temporary files created by the processes.
+
+    def _retry(self, job):
+        """Schedules a failed job to be retried with exponential backoff, so that transient failures do not stall the other jobs.
+        Once out of retries, the job is skipped and its file added to 'failed'.
 
         Args:
-            jobs (list[ReencodeJob]): Jobs to wait for
+            job (ReencodeJob): Job that failed (must not be running)
         """
-        for job in self.jobs:
+        if job.retries < max_retries:
+            delay = 2 ** job.retries
+            job.retries += 1
+            self.log.warning("File '%s': retrying in %d second(s) (attempt %d/%d).", job.file, delay, job.retries, max_retries)
+            heapq.heappush(self.retry_queue, (time.time() + delay, self.retry_seq, job))
+            self.retry_seq += 1
+
+        # skip
+        else:
+            self.log.error("File '%s': giving up after %d retries, skipping.", job.file, job.retries)
+            self.failed.append(job.file)
+    
+    def wait(self):
+        """Wait for the processes of all running jobs to terminate, and if necessary removes the temporary files created by the processes."""
+        for job in self.jobs.values():
             job.wait()
             
     def poll(self):
         found = False
-        for job in self.jobs:
+        for job in list(self.jobs.values()):
             found |= self.finish(job)
         return found
+
+    def has_retries(self):
+        """Returns whether failed jobs are waiting to be retried."""
+        return len(self.retry_queue) > 0
+
+    def _start_retries(self):
+        """Restarts the failed jobs whose backoff delay has elapsed, as long as there are free slots."""
+        now = time.time()
+        while len(self.retry_queue) > 0 and self.retry_queue[0][0] <= now and len(self.jobs) < n_parallel:
+            job = heapq.heappop(self.retry_queue)[2]
+            self._start(job)
+
+    def _wait_timeout(self):
+        """Returns how long 'wait_any' may block (in seconds), or None if it can block until a process terminates."""
+        timeout = None
+        if REENCODE_TIMEOUT is not None:
+            timeout = 1
+        # A retry can only start once a slot is free, so while all slots are busy, wait for a job to finish instead
+        if len(self.retry_queue) > 0 and len(self.jobs) < n_parallel:
+            delay = max(self.retry_queue[0][0] - time.time(), 0)
+            timeout = delay if timeout is None else min(timeout, delay)
+        return timeout
+
+    def wait_any(self):
+        """Block until at least one child process has terminated.
+        The process is not reaped, so that 'finish' can still collect its exit status.
+        When jobs may time out, returns after at most a second so that 'poll' can check them.
+        When jobs are waiting to be retried, returns once the next one is ready.
+
+        Returns:
+            ReencodeJob: The job whose process terminated, or None if unknown.
+        """
+        timeout = self._wait_timeout()
+
+        # Only waiting for a retry
+        if len(self.jobs) == 0:
+            if timeout is not None:
+                time.sleep(timeout)
+            return None
+
+        # On Linux, wait until a process file descriptor becomes readable
+        if self.epoll is not None:
+            events = self.epoll.poll(timeout if timeout is not None else -1)
+            return self.pidfd_jobs[events[0][0]] if len(events) > 0 else None
+
+        # On Windows, wait on the process handles.
+        # 'Popen._handle' is private, so fall back to sleeping and polling if it is missing.
+        # Note: this path has not been tested on Windows.
+        if os.name == 'nt' and all(hasattr(job.proc, '_handle') for job in self.jobs.values()):
+            handles = {int(job.proc._handle): job for job in self.jobs.values()}
+            ready = multiprocessing.connection.wait(list(handles.keys()), timeout)
+            return handles[ready[0]] if len(ready) > 0 else None
+
+        # os.waitid cannot time out, so fall back to sleeping if needed
+        if not hasattr(os, 'waitid') or timeout is not None:
+            time.sleep(timeout if timeout is not None else 1)
+            return None
+
+        try:
+            result = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            return None
+        if result is None:
+            return None
+
+        job = self.jobs.get(result.si_pid)
+
+        # Reap children we do not own, otherwise they would wake us up forever
+        if job is None:
+            os.waitpid(result.si_pid, 0)
+
+        return job
+
+    def finish_any(self):
+        """Block until at least one job has finished, and check it (see 'finish'). Then restart the failed jobs that are ready to be retried."""
+        job = self.wait_any()
+        if job is not None:
+            self.finish(job, wait=True)
+        else:
+            self.poll()
+        self._start_retries()
         
     def communicate(self):
-        for job in self.jobs:
+        for job in list(self.jobs.values()):
             self.finish(job, wait=True)
         
+    def n_threads(self):
+        """Returns the number of encoder threads used by the running jobs."""
+        return sum(job.threads for job in self.jobs.values())
+
     def __len__(self):
         return len(self.jobs)
         
     def __repr___(self):
-        return str(self.jobs)
+        return str(list(self.jobs.values()))
         
     def __str__(self):
-        return str(self.jobs)
+        return str(list(self.jobs.values()))
 
 
 
@@ -328,7 +1262,10 @@ def reencode_files(files):
     """Re-encodes a list of files.
 
     Args:
-        files (list[str]): List of file paths to re-encode.
+        files (list[tuple[str, str]]): List of file paths to re-encode, and the same paths relative to 'root_folder'.
+
+    Returns:
+        list[str]: Paths of the files that could not be re-encoded, even after retrying.
     """
 
     logger = logging.getLogger('reencode_files')
@@ -338,35 +1275,65 @@ def reencode_files(files):
     total_len = len(str(total))
     i = 0
 
+    # The total and the padding are the same for every line, so format them into the template once
+    progress_fmt = "%%%dd/%d (%%d%%%%): Re-encoding '%%s'...\n" % (total_len, total)
+
     jobs = ReencodeJobList()
 
+    # Total number of encoder threads to keep busy
+    max_threads = n_parallel * flac_threads
+
+    # Progress lines are buffered while jobs are being started, and written in one go
+    # before the jobs are checked (which may log or prompt the user)
+    progress = []
+    def flush_progress():
+        if len(progress) > 0:
+            sys.stdout.write(''.join(progress))
+            sys.stdout.flush()
+            del progress[:]
+
     logger.info("Starting re-encode process using %d thread(s)...", n_parallel)
 
     try:
-        for file in files:
+        for file, rel_path in files:
             i += 1
-            i_padded = str(i).rjust(total_len, ' ')
-            i_pct = float(i) / total * 100
-            rel_path = os.path.relpath(file, root_folder)
-            print("%s/%d (%d%%): Re-encoding '%s'..." % (i_padded, total, i_pct, rel_path))
+            progress.append(progress_fmt % (i, i * 100 // total, rel_path))
 
-            jobs.start(file)
+            # With fewer files than slots, every file starts right away, so split the whole thread budget between them.
+            # Otherwise a slot only frees up once a job finishes, so there are never spare threads to hand out.
+            threads = flac_threads
+            remaining = total - i + 1
+            if flac_spread_threads and total < n_parallel:
+                free_threads = max_threads - jobs.n_threads()
+                threads = min(max(flac_threads, free_threads // remaining), FLAC_MAX_THREADS)
+
+            jobs.start(file, threads)
 
             # Limit number of processes to n_parallel
             # If limit is reached, wait until at least one finishes
+            if len(jobs) >= n_parallel:
+                flush_progress()
             while len(jobs) >= n_parallel:
-                if not jobs.poll():
-                    time.sleep(1)
+                jobs.finish_any()
+
+        flush_progress()
+
+        # Check the remaining jobs as they finish, so that failures are also handled (and retried) for the last files
+        while len(jobs) > 0 or jobs.has_retries():
+            jobs.finish_any()
+
+        if len(jobs.failed) > 0:
+            logger.error("%d file(s) could not be re-encoded:\n%s", len(jobs.failed), '\n'.join(jobs.failed))
+
+        return jobs.failed
 
     except KeyboardInterrupt as e: # subprocesses also receive the signal
+        flush_progress()
         logger.critical("Keyboard Interrupt (Ctrl-C) detected. Waiting for encoder(s) to cancel...")
         jobs.wait()
         logger.critical("Exiting.")
         sys.exit(-3)
 
-    # Make sure all sub-processes exit before terminating
-    jobs.wait()
-
 
 
 